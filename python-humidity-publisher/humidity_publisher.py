@@ -6,6 +6,8 @@ import os
 import signal
 import sys
 import random
+import json
+import threading
 from datetime import datetime
 
 # MQTT configuration from environment variables or defaults
@@ -19,6 +21,15 @@ base_humidity = float(os.environ.get("BASE_HUMIDITY", "60.0"))  # Base humidity
 day_variation = float(os.environ.get("DAY_VARIATION", "15.0"))  # Daily humidity variation
 noise_level = float(os.environ.get("NOISE_LEVEL", "2.0"))  # Random noise level
 
+# Publishing rate, adjustable at runtime through the feedback topic
+default_interval = float(os.environ.get("PUBLISH_INTERVAL", "1.0"))  # seconds
+publish_interval = default_interval
+batch_size = 1  # Readings per message
+max_batch_size = int(os.environ.get("MAX_BATCH_SIZE", "100"))  # Upper bound for requested batch sizes
+report_threshold = 0.0  # Minimum change before a reading is published (0 = always)
+pressure = {}  # Flow control requests by source
+wake = threading.Event()  # Set when a command should cut the current wait short
+
 # Flag to control the publishing loop
 running = True
 
@@ -27,6 +38,7 @@ def signal_handler(sig, frame):
     global running
     print("Shutdown signal received. Exiting...")
     running = False
+    wake.set()
 
 # Register signal handlers
 signal.signal(signal.SIGINT, signal_handler)
@@ -42,6 +54,103 @@ def on_connect(client, userdata, flags, rc):
     else:
         print(f"Connection failed with code {rc}")
 
+def parse_command(payload):
+    """Parse a feedback payload into a command dict
+    
+    Accepts the plain "stop" string as well as JSON control messages such as
+    {"command": "throttle", "factor": 2.0, "source": "DataProcessor"}.
+    """
+    try:
+        command = json.loads(payload)
+    except json.JSONDecodeError:
+        command = None
+    if not isinstance(command, dict):
+        return {"command": payload.strip().lower()}
+    command["command"] = str(command.get("command", "")).lower()
+    return command
+
+def positive_number(value, field):
+    """Convert a command field to a finite number greater than zero"""
+    number = float(value)
+    if not math.isfinite(number) or number <= 0:
+        raise ValueError(f"{field} must be a finite number greater than zero, got {value}")
+    return number
+
+def apply_flow_control():
+    """Derive the publishing behaviour from the most restrictive active request"""
+    global publish_interval, batch_size, report_threshold
+    factor = max((request.get("factor", 1.0) for request in pressure.values()), default=1.0)
+    publish_interval = default_interval * max(factor, 1.0)
+    batch_size = max((request.get("size", 1) for request in pressure.values()), default=1)
+    report_threshold = max((request.get("threshold", 0.0) for request in pressure.values()), default=0.0)
+    print(f"Flow control: interval={publish_interval}s, batch size={batch_size}, "
+          f"report threshold={report_threshold}%")
+
+def handle_command(command):
+    """Apply a control command received on the feedback topic"""
+    global running, default_interval, base_humidity, day_variation, noise_level
+    name = command["command"]
+    source = command.get("source", "manual")
+    
+    try:
+        if name == "stop":
+            print("Stop command received. Shutting down...")
+            running = False
+        elif name == "throttle":
+            pressure.setdefault(source, {})["factor"] = positive_number(command.get("factor", 2.0), "factor")
+            apply_flow_control()
+        elif name == "batch":
+            pressure.setdefault(source, {})["size"] = max(1, min(max_batch_size, int(command.get("size", 10))))
+            apply_flow_control()
+        elif name == "report_by_exception":
+            scale = positive_number(command.get("scale", 1.0), "scale")
+            threshold = float(command.get("threshold", noise_level * scale))
+            if not math.isfinite(threshold) or threshold < 0:
+                raise ValueError(f"threshold must be a finite number of at least zero, got {threshold}")
+            pressure.setdefault(source, {})["threshold"] = threshold
+            apply_flow_control()
+        elif name == "resume":
+            # A manual resume clears every request, a controller only its own
+            if source == "manual":
+                pressure.clear()
+            else:
+                pressure.pop(source, None)
+            apply_flow_control()
+        elif name == "configure":
+            # Validate every field before applying any of them
+            interval = default_interval
+            if "publish_interval" in command:
+                interval = positive_number(command["publish_interval"], "publish_interval")
+            base = float(command.get("base_humidity", base_humidity))
+            variation = float(command.get("day_variation", day_variation))
+            noise = float(command.get("noise_level", noise_level))
+            if not all(math.isfinite(value) for value in (base, variation, noise)):
+                raise ValueError("simulation parameters must be finite numbers")
+            default_interval, base_humidity, day_variation, noise_level = interval, base, variation, noise
+            print(f"Configuration updated: base={base_humidity}%, variation={day_variation}%, "
+                  f"noise={noise_level}%")
+            apply_flow_control()
+        else:
+            print(f"Unknown command: {name}")
+    except (ValueError, TypeError, OverflowError) as e:
+        print(f"Invalid {name} command: {e}")
+    
+    # Let the publishing loop pick up the change right away
+    wake.set()
+
+def wait_for_next_reading(started):
+    """Wait until publish_interval has passed since `started`
+    
+    The wait is cut short by commands, so a new interval, a resume or a
+    stop takes effect without sitting out the previous interval.
+    """
+    while running:
+        remaining = started + publish_interval - time.time()
+        if remaining <= 0:
+            return
+        wake.wait(remaining)
+        wake.clear()
+
 def on_message(client, userdata, message):
     """Handle incoming messages"""
     payload = message.payload.decode('utf-8')
@@ -49,10 +158,7 @@ def on_message(client, userdata, message):
     
     # Process commands
     if message.topic == feedback_topic:
-        if payload.lower() == "stop":
-            print("Stop command received. Shutting down...")
-            global running
-            running = False
+        handle_command(parse_command(payload))
 
 def on_disconnect(client, userdata, rc):
     """Called when disconnected from MQTT broker"""
@@ -74,12 +180,26 @@ def simulate_humidity(timestamp):
     
     return round(humidity, 1)
 
+def publish_batch(readings):
+    """Publish a single reading, or a JSON array when readings were batched"""
+    if len(readings) == 1:
+        payload = f"{readings[0]:.1f}"
+    else:
+        payload = json.dumps(readings)
+    
+    info = client.publish(pub_topic, payload)
+    print(f"Published to {pub_topic}: {payload}% at {datetime.now().strftime('%H:%M:%S')}")
+    return info
+
 # Set up MQTT client
 client = mqtt.Client(client_id)
 client.on_connect = on_connect
 client.on_message = on_message
 client.on_disconnect = on_disconnect
 
+# Readings waiting to be published together
+batch = []
+
 try:
     # Connect to broker
     print(f"Connecting to broker: {broker_address}")
@@ -87,26 +207,43 @@ try:
     client.loop_start()
     
     # Main publishing loop
+    last_reported = None
     while running:
+        started = time.time()
+        
         # Get current time and simulate humidity
         now = datetime.now()
         humidity = simulate_humidity(now)
         
-        # Create payload with humidity value
-        payload = f"{humidity:.1f}"
+        # Report by exception: skip readings that barely changed
+        if (report_threshold > 0 and last_reported is not None and
+                abs(humidity - last_reported) < report_threshold):
+            wait_for_next_reading(started)
+            continue
+        last_reported = humidity
+        batch.append(humidity)
         
-        # Publish to topic
-        client.publish(pub_topic, payload)
-        print(f"Published to {pub_topic}: {payload}% at {now.strftime('%H:%M:%S')}")
+        if len(batch) >= batch_size:
+            publish_batch(batch)
+            batch = []
         
         # Wait before next reading
-        time.sleep(1)
+        wait_for_next_reading(started)
     
 except KeyboardInterrupt:
     print("Keyboard interrupt received. Exiting...")
 except Exception as e:
     print(f"Error: {e}")
 finally:
+    # Publish readings still waiting in a partial batch
+    if batch:
+        info = publish_batch(batch)
+        if info.rc == mqtt.MQTT_ERR_SUCCESS:
+            try:
+                info.wait_for_publish(timeout=5)
+            except (ValueError, RuntimeError) as e:
+                print(f"Error publishing final batch: {e}")
+    
     # Clean up
     client.loop_stop()
     client.disconnect()
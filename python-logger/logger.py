@@ -5,6 +5,8 @@ import signal
 import sys
 import json
 import time
+import queue
+import threading
 import logging
 from datetime import datetime
 from logging.handlers import RotatingFileHandler
@@ -21,6 +23,23 @@ log_file = os.path.join(log_dir, "mqtt_messages.log")
 max_log_size = int(os.environ.get("MAX_LOG_SIZE", 10 * 1024 * 1024))  # 10 MB by default
 backup_count = int(os.environ.get("BACKUP_COUNT", 5))  # Keep 5 backup files
 
+# Flow control configuration
+intake_queue_size = int(os.environ.get("INTAKE_QUEUE_SIZE", "10000"))  # Max buffered messages
+flow_control_topics = os.environ.get("FLOW_CONTROL_TOPICS",
+                                     "feedback/temperature,feedback/humidity,feedback/processor")
+flow_control_mode = os.environ.get("FLOW_CONTROL_MODE", "throttle")  # throttle, batch or report_by_exception
+high_watermark = int(os.environ.get("FLOW_HIGH_WATERMARK", "1000"))  # Queue depth that raises pressure
+low_watermark = int(os.environ.get("FLOW_LOW_WATERMARK", "100"))  # Queue depth that releases pressure
+max_lag = float(os.environ.get("FLOW_MAX_LAG", "5.0"))  # Seconds a message may wait before raising pressure
+flow_refresh = float(os.environ.get("FLOW_REFRESH", "10.0"))  # Seconds between repeated or raised pressure requests
+flow_max_level = int(os.environ.get("FLOW_MAX_LEVEL", "5"))  # Number of times pressure may be doubled
+throttle_only_topics = os.environ.get("FLOW_THROTTLE_ONLY_TOPICS", "feedback/processor")  # Topics that only understand throttle
+
+# Messages waiting to be written
+intake = queue.Queue(maxsize=intake_queue_size)
+dropped_messages = 0
+drop_lock = threading.Lock()  # Guards dropped_messages across the network and main threads
+
 # Flag to control the logging loop
 running = True
 
@@ -76,24 +95,53 @@ def on_connect(client, userdata, flags, rc):
         # Subscribe to feedback topic
         client.subscribe(feedback_topic)
         logger.info(f"Subscribed to feedback topic: {feedback_topic}")
+        # Clear requests left over from a previous run
+        if not flow_controller.throttled:
+            flow_controller.send({"command": "resume"})
     else:
         logger.error(f"Connection failed with code {rc}")
 
+def parse_command(payload):
+    """Parse a feedback payload into a command dict
+    
+    Accepts the plain "stop" string as well as JSON control messages such as
+    {"command": "stop"}.
+    """
+    try:
+        command = json.loads(payload)
+    except json.JSONDecodeError:
+        command = None
+    if not isinstance(command, dict):
+        return {"command": payload.strip().lower()}
+    command["command"] = str(command.get("command", "")).lower()
+    return command
+
 def on_message(client, userdata, message):
     """Handle incoming messages"""
+    global running, dropped_messages
     topic = message.topic
     payload = message.payload.decode('utf-8').strip()
     
-    # Process commands on the feedback topic
+    # Process commands immediately so they are never stuck behind queued messages
     if topic == feedback_topic:
         logger.info(f"Received command on {topic}: {payload}")
-        if payload.lower() == "stop":
+        command = parse_command(payload)
+        if command["command"] == "stop":
             logger.info("Stop command received. Shutting down...")
-            global running
             running = False
+        else:
+            logger.warning(f"Unsupported command: {command['command']}")
         return
     
-    # Log the message
+    # Queue the message for the main loop
+    try:
+        intake.put_nowait((topic, payload, time.time()))
+    except queue.Full:
+        with drop_lock:
+            dropped_messages += 1
+
+def log_message(topic, payload):
+    """Write a message to the log"""
     try:
         # Try to parse as JSON for formatted logging
         json_payload = json.loads(payload)
@@ -106,21 +154,105 @@ def on_disconnect(client, userdata, rc):
     """Called when disconnected from MQTT broker"""
     logger.info(f"Disconnected with result code {rc}")
 
+class FlowController:
+    """Ask publishers to back off over their feedback topics when intake falls behind
+    
+    Pressure is raised once the queue depth or lag crosses the high watermark
+    and released once both are back below the low watermark. The request is
+    repeated every `refresh` seconds so that restarted publishers pick it up
+    again, and while overload persists each repeat doubles the requested
+    throttle factor, batch size or report threshold, up to `max_level` times.
+    Topics in `throttle_only` belong to services that only understand throttle.
+    """
+    
+    def __init__(self, client, topics, mode, throttle_only, high_watermark, low_watermark,
+                 max_lag, refresh, max_level):
+        self.client = client
+        self.topics = [topic.strip() for topic in topics.split(",") if topic.strip()]
+        self.throttle_only = {topic.strip() for topic in throttle_only.split(",") if topic.strip()}
+        self.mode = mode
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.max_lag = max_lag
+        self.refresh = refresh
+        self.max_level = max_level
+        self.level = 0
+        self.throttled = False
+        self.last_sent = 0
+    
+    def pressure_command(self, mode):
+        """Build the request for `mode` at the current pressure level"""
+        scale = 2 ** max(self.level - 1, 0)
+        if mode == "batch":
+            return {"command": "batch", "size": 10 * scale}
+        if mode == "report_by_exception":
+            return {"command": "report_by_exception", "scale": scale}
+        return {"command": "throttle", "factor": 2.0 * scale}
+    
+    def send(self, command=None):
+        """Publish a control command, or the current pressure request, to every managed publisher"""
+        for topic in self.topics:
+            request = command
+            if request is None:
+                request = self.pressure_command("throttle" if topic in self.throttle_only else self.mode)
+            self.client.publish(topic, json.dumps(dict(request, source=client_id)), qos=1)
+        self.last_sent = time.time()
+    
+    def check(self, depth, lag):
+        """Raise, escalate, repeat or release pressure based on the current intake state"""
+        overloaded = depth >= self.high_watermark or lag >= self.max_lag
+        relieved = depth <= self.low_watermark and lag < self.max_lag / 2
+        
+        if self.throttled and relieved:
+            logger.info(f"Intake recovered (depth={depth}, lag={lag:.2f}s). Resuming publishers...")
+            self.throttled = False
+            self.level = 0
+            self.send({"command": "resume"})
+        elif overloaded and not self.throttled:
+            logger.warning(f"Intake overloaded (depth={depth}, lag={lag:.2f}s). Sending {self.mode}...")
+            self.throttled = True
+            self.level = 1
+            self.send()
+        elif self.throttled and time.time() - self.last_sent >= self.refresh:
+            if overloaded and self.level <= self.max_level:
+                self.level += 1
+                logger.warning(f"Intake still overloaded (depth={depth}, lag={lag:.2f}s). "
+                               f"Raising pressure to level {self.level}...")
+            self.send()
+
 # Set up MQTT client
 client = mqtt.Client(client_id)
 client.on_connect = on_connect
 client.on_message = on_message
 client.on_disconnect = on_disconnect
 
+# Set up flow control towards the publishers
+flow_controller = FlowController(client, flow_control_topics, flow_control_mode, throttle_only_topics,
+                                 high_watermark, low_watermark, max_lag, flow_refresh, flow_max_level)
+
 try:
     # Connect to broker
     logger.info(f"Connecting to broker: {broker_address}")
     client.connect(broker_address)
     client.loop_start()
     
-    # Main loop to keep the script running
+    # Main loop writing queued messages to the log
     while running:
-        time.sleep(1)
+        try:
+            topic, payload, received = intake.get(timeout=1)
+        except queue.Empty:
+            flow_controller.check(0, 0.0)
+            continue
+        
+        lag = time.time() - received
+        log_message(topic, payload)
+        
+        with drop_lock:
+            dropped, dropped_messages = dropped_messages, 0
+        if dropped:
+            logger.warning(f"Intake queue full, dropped {dropped} messages")
+        
+        flow_controller.check(intake.qsize(), lag)
     
 except KeyboardInterrupt:
     logger.info("Keyboard interrupt received. Exiting...")
@@ -6,6 +6,10 @@ import os
 import signal
 import sys
 import json
+import threading
+import importlib
+import queue
+from collections import OrderedDict, deque
 from datetime import datetime
 
 # MQTT configuration from environment variables or defaults
@@ -16,11 +20,31 @@ output_topic = os.environ.get("MQTT_OUTPUT_TOPIC", "sensoren/processed")
 feedback_topic = os.environ.get("MQTT_FEEDBACK_TOPIC", "feedback/processor")
 client_id = os.environ.get("MQTT_CLIENT_ID", "DataProcessor")
 
+# Derived metrics configuration
+quantize_step = float(os.environ.get("DERIVED_QUANTIZE_STEP", "0.1"))  # Input resolution for memoization
+cache_size = int(os.environ.get("DERIVED_CACHE_SIZE", "1024"))  # Max memoized results
+delta_window = int(os.environ.get("DELTA_WINDOW", "10"))  # Readings spanned by rolling deltas
+plugin_modules = os.environ.get("PROCESSOR_PLUGINS", "")  # Comma-separated plugin module names
+
+# Flow control configuration
+intake_queue_size = int(os.environ.get("INTAKE_QUEUE_SIZE", "10000"))  # Max buffered sensor messages
+flow_control_topics = os.environ.get("FLOW_CONTROL_TOPICS", "feedback/temperature,feedback/humidity")
+flow_control_mode = os.environ.get("FLOW_CONTROL_MODE", "throttle")  # throttle, batch or report_by_exception
+high_watermark = int(os.environ.get("FLOW_HIGH_WATERMARK", "100"))  # Queue depth that raises pressure
+low_watermark = int(os.environ.get("FLOW_LOW_WATERMARK", "10"))  # Queue depth that releases pressure
+max_lag = float(os.environ.get("FLOW_MAX_LAG", "2.0"))  # Seconds a message may wait before raising pressure
+flow_refresh = float(os.environ.get("FLOW_REFRESH", "10.0"))  # Seconds between repeated or raised pressure requests
+flow_max_level = int(os.environ.get("FLOW_MAX_LEVEL", "5"))  # Number of times pressure may be doubled
+throttle_only_topics = os.environ.get("FLOW_THROTTLE_ONLY_TOPICS", "")  # Topics that only understand throttle
+
 # Data storage
-last_temp = None
-last_humidity = None
-publish_interval = float(os.environ.get("PUBLISH_INTERVAL", "1.0"))  # seconds
+default_interval = float(os.environ.get("PUBLISH_INTERVAL", "1.0"))  # seconds
+publish_interval = default_interval
 last_publish_time = 0
+intake = queue.Queue(maxsize=intake_queue_size)
+dropped_messages = 0
+drop_lock = threading.Lock()  # Guards dropped_messages across the network and main threads
+pressure = {}  # Throttle requests by source
 
 # Flag to control the processing loop
 running = True
@@ -47,34 +71,110 @@ def on_connect(client, userdata, flags, rc):
         # Subscribe to feedback topic
         client.subscribe(feedback_topic)
         print(f"Subscribed to feedback topic: {feedback_topic}")
+        # Clear requests left over from a previous run
+        if not flow_controller.throttled:
+            flow_controller.send({"command": "resume"})
     else:
         print(f"Connection failed with code {rc}")
 
+def parse_command(payload):
+    """Parse a feedback payload into a command dict
+    
+    Accepts the plain "stop" string as well as JSON control messages such as
+    {"command": "throttle", "factor": 2.0, "source": "MQTTLogger"}.
+    """
+    try:
+        command = json.loads(payload)
+    except json.JSONDecodeError:
+        command = None
+    if not isinstance(command, dict):
+        return {"command": payload.strip().lower()}
+    command["command"] = str(command.get("command", "")).lower()
+    return command
+
+def positive_number(value, field):
+    """Convert a command field to a finite number greater than zero"""
+    number = float(value)
+    if not math.isfinite(number) or number <= 0:
+        raise ValueError(f"{field} must be a finite number greater than zero, got {value}")
+    return number
+
+def apply_flow_control():
+    """Derive the publish interval from the most restrictive active request"""
+    global publish_interval
+    factor = max((request.get("factor", 1.0) for request in pressure.values()), default=1.0)
+    publish_interval = default_interval * max(factor, 1.0)
+    print(f"Flow control: publish interval={publish_interval}s")
+
+def handle_command(command):
+    """Apply a control command received on the feedback topic"""
+    global running, default_interval
+    name = command["command"]
+    source = command.get("source", "manual")
+    
+    try:
+        if name == "stop":
+            print("Stop command received. Shutting down...")
+            running = False
+        elif name == "throttle":
+            pressure.setdefault(source, {})["factor"] = positive_number(command.get("factor", 2.0), "factor")
+            apply_flow_control()
+        elif name == "resume":
+            # A manual resume clears every request, a controller only its own
+            if source == "manual":
+                pressure.clear()
+            else:
+                pressure.pop(source, None)
+            apply_flow_control()
+        elif name == "configure":
+            if "publish_interval" in command:
+                default_interval = positive_number(command["publish_interval"], "publish_interval")
+            apply_flow_control()
+        else:
+            print(f"Unsupported command: {name}")
+    except (ValueError, TypeError, OverflowError) as e:
+        print(f"Invalid {name} command: {e}")
+
 def on_message(client, userdata, message):
     """Handle incoming messages"""
+    global dropped_messages
     topic = message.topic
     payload = message.payload.decode('utf-8').strip()
     
-    # Process commands
+    # Process commands immediately so they are never stuck behind sensor data
     if topic == feedback_topic:
         print(f"Received command on {topic}: {payload}")
-        if payload.lower() == "stop":
-            print("Stop command received. Shutting down...")
-            global running
-            running = False
+        handle_command(parse_command(payload))
         return
-        
-    # Process sensor data
+    
+    # Queue sensor data for the main loop
+    try:
+        intake.put_nowait((topic, payload, time.time()))
+    except queue.Full:
+        with drop_lock:
+            dropped_messages += 1
+
+def parse_readings(payload):
+    """Parse a sensor payload into its readings, unpacking batched JSON arrays"""
+    if payload.startswith("["):
+        readings = [float(reading) for reading in json.loads(payload)]
+        if not readings:
+            raise ValueError("empty batch")
+        return readings
+    return [float(payload)]
+
+def process_reading(topic, payload):
+    """Feed a queued sensor message into the derived metrics pipeline"""
     try:
         if topic == temp_topic:
-            global last_temp
-            last_temp = float(payload)
-            print(f"Received temperature: {last_temp}°C")
+            for temperature in parse_readings(payload):
+                pipeline.update("temperature", temperature)
+                print(f"Received temperature: {temperature}°C")
         elif topic == humidity_topic:
-            global last_humidity
-            last_humidity = float(payload)
-            print(f"Received humidity: {last_humidity}%")
-    except ValueError as e:
+            for humidity in parse_readings(payload):
+                pipeline.update("humidity", humidity)
+                print(f"Received humidity: {humidity}%")
+    except (ValueError, TypeError) as e:
         print(f"Error parsing data from {topic}: {e}")
 
 def on_disconnect(client, userdata, rc):
@@ -112,12 +212,234 @@ def calculate_dew_point(temp_c, humidity):
     dew_point = (b * gamma) / (a - gamma)
     return round(dew_point, 1)
 
+def calculate_absolute_humidity(temp_c, humidity):
+    """Calculate the absolute humidity in g/m³"""
+    # Saturation vapour pressure in hPa (Magnus formula)
+    saturation = 6.112 * math.exp((17.67 * temp_c) / (temp_c + 243.5))
+    
+    absolute_humidity = (saturation * humidity * 2.1674) / (273.15 + temp_c)
+    return round(absolute_humidity, 2)
+
+def rolling_delta(history):
+    """Create a function returning the change across a reading history"""
+    def delta(value):
+        return round(history[-1] - history[0], 2)
+    
+    return delta
+
+class MetricPipeline:
+    """Derived metrics declared as nodes over named inputs
+    
+    Sensor readings are fed in with update(). recompute() only evaluates the
+    nodes whose inputs changed since the last call, in registration order, so
+    a node may depend on any node registered before it. Stateless nodes are
+    memoized on their quantized inputs in a bounded LRU cache. A node that
+    fails is dropped from the results together with the nodes depending on it.
+    """
+    
+    def __init__(self, inputs, quantize_step, cache_size):
+        self.inputs = frozenset(inputs)
+        self.quantize_step = quantize_step
+        self.cache_size = cache_size
+        self.metrics = OrderedDict()  # name -> (inputs, func, cacheable)
+        self.values = {}
+        self.dirty = set()
+        self.histories = {}  # input name -> list of reading deques, one per caller
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+    
+    def register(self, name, inputs, cacheable=True):
+        """Decorator registering a function as the derived metric `name`"""
+        def decorator(func):
+            if name in self.metrics:
+                raise ValueError(f"Derived metric already registered: {name}")
+            if name in self.inputs or name == "timestamp":
+                raise ValueError(f"Derived metric name is reserved: {name}")
+            with self.lock:
+                self.metrics[name] = (tuple(inputs), func, cacheable)
+                # Compute the new node on the next pass if its inputs are available
+                self.dirty.update(inputs)
+            return func
+        return decorator
+    
+    def history(self, name, readings):
+        """Return a new history of the last `readings` values received for an input
+        
+        Each caller gets its own deque, so windows of different lengths never
+        share or replace each other. Every reading is recorded, and a tracked
+        input is marked changed on each reading even if its value repeats,
+        since its history moved.
+        """
+        history = deque(maxlen=readings)
+        with self.lock:
+            self.histories.setdefault(name, []).append(history)
+        return history
+    
+    def update(self, name, value):
+        """Store a new input value, marking it changed if it differs"""
+        with self.lock:
+            histories = self.histories.get(name, ())
+            for history in histories:
+                history.append(value)
+            if histories:
+                self.dirty.add(name)
+            if self.values.get(name) != value:
+                self.values[name] = value
+                self.dirty.add(name)
+    
+    def quantize(self, value):
+        """Round a numeric value to the configured input resolution"""
+        if self.quantize_step <= 0 or isinstance(value, bool) or not isinstance(value, (int, float)):
+            return value
+        return round(round(value / self.quantize_step) * self.quantize_step, 6)
+    
+    def evaluate(self, name, func, args, cacheable):
+        """Evaluate a node, serving stateless nodes from the cache"""
+        if not cacheable:
+            return func(*args)
+        
+        key = (name,) + tuple(self.quantize(arg) for arg in args)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        
+        result = func(*key[1:])
+        self.cache[key] = result
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return result
+    
+    def recompute(self):
+        """Recompute the nodes affected by changed inputs and return a snapshot"""
+        with self.lock:
+            changed = self.dirty
+            self.dirty = set()
+            
+            for name, (inputs, func, cacheable) in self.metrics.items():
+                if changed.isdisjoint(inputs):
+                    continue
+                args = [self.values.get(key) for key in inputs]
+                if any(arg is None for arg in args):
+                    self.drop(name, changed)
+                    continue
+                try:
+                    result = self.evaluate(name, func, args, cacheable)
+                except Exception as e:
+                    # A failing node, e.g. a broken plugin, must not stop the processor
+                    print(f"Error calculating {name}: {e}")
+                    self.drop(name, changed)
+                    continue
+                if self.values.get(name) != result:
+                    self.values[name] = result
+                    changed.add(name)
+            
+            return dict(self.values)
+    
+    def drop(self, name, changed):
+        """Remove a stale node value so it is not published and dependents are dropped too"""
+        if self.values.pop(name, None) is not None:
+            changed.add(name)
+
+def load_plugins(pipeline, modules):
+    """Import plugin modules and let each register its derived metrics
+    
+    A plugin is any importable module defining register(pipeline).
+    """
+    for module_name in filter(None, (name.strip() for name in modules.split(","))):
+        try:
+            module = importlib.import_module(module_name)
+            module.register(pipeline)
+            print(f"Loaded derived metrics plugin: {module_name}")
+        except Exception as e:
+            print(f"Error loading plugin {module_name}: {e}")
+
+# Set up derived metrics pipeline
+pipeline = MetricPipeline(("temperature", "humidity"), quantize_step, cache_size)
+pipeline.register("heat_index", ("temperature", "humidity"))(calculate_heat_index)
+pipeline.register("dew_point", ("temperature", "humidity"))(calculate_dew_point)
+pipeline.register("absolute_humidity", ("temperature", "humidity"))(calculate_absolute_humidity)
+pipeline.register("temperature_delta", ("temperature",), cacheable=False)(
+    rolling_delta(pipeline.history("temperature", delta_window + 1)))
+pipeline.register("humidity_delta", ("humidity",), cacheable=False)(
+    rolling_delta(pipeline.history("humidity", delta_window + 1)))
+load_plugins(pipeline, plugin_modules)
+
+class FlowController:
+    """Ask publishers to back off over their feedback topics when intake falls behind
+    
+    Pressure is raised once the queue depth or lag crosses the high watermark
+    and released once both are back below the low watermark. The request is
+    repeated every `refresh` seconds so that restarted publishers pick it up
+    again, and while overload persists each repeat doubles the requested
+    throttle factor, batch size or report threshold, up to `max_level` times.
+    Topics in `throttle_only` belong to services that only understand throttle.
+    """
+    
+    def __init__(self, client, topics, mode, throttle_only, high_watermark, low_watermark,
+                 max_lag, refresh, max_level):
+        self.client = client
+        self.topics = [topic.strip() for topic in topics.split(",") if topic.strip()]
+        self.throttle_only = {topic.strip() for topic in throttle_only.split(",") if topic.strip()}
+        self.mode = mode
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.max_lag = max_lag
+        self.refresh = refresh
+        self.max_level = max_level
+        self.level = 0
+        self.throttled = False
+        self.last_sent = 0
+    
+    def pressure_command(self, mode):
+        """Build the request for `mode` at the current pressure level"""
+        scale = 2 ** max(self.level - 1, 0)
+        if mode == "batch":
+            return {"command": "batch", "size": 10 * scale}
+        if mode == "report_by_exception":
+            return {"command": "report_by_exception", "scale": scale}
+        return {"command": "throttle", "factor": 2.0 * scale}
+    
+    def send(self, command=None):
+        """Publish a control command, or the current pressure request, to every managed publisher"""
+        for topic in self.topics:
+            request = command
+            if request is None:
+                request = self.pressure_command("throttle" if topic in self.throttle_only else self.mode)
+            self.client.publish(topic, json.dumps(dict(request, source=client_id)), qos=1)
+        self.last_sent = time.time()
+    
+    def check(self, depth, lag):
+        """Raise, escalate, repeat or release pressure based on the current intake state"""
+        overloaded = depth >= self.high_watermark or lag >= self.max_lag
+        relieved = depth <= self.low_watermark and lag < self.max_lag / 2
+        
+        if self.throttled and relieved:
+            print(f"Intake recovered (depth={depth}, lag={lag:.2f}s). Resuming publishers...")
+            self.throttled = False
+            self.level = 0
+            self.send({"command": "resume"})
+        elif overloaded and not self.throttled:
+            print(f"Intake overloaded (depth={depth}, lag={lag:.2f}s). Sending {self.mode}...")
+            self.throttled = True
+            self.level = 1
+            self.send()
+        elif self.throttled and time.time() - self.last_sent >= self.refresh:
+            if overloaded and self.level <= self.max_level:
+                self.level += 1
+                print(f"Intake still overloaded (depth={depth}, lag={lag:.2f}s). "
+                      f"Raising pressure to level {self.level}...")
+            self.send()
+
 # Set up MQTT client
 client = mqtt.Client(client_id)
 client.on_connect = on_connect
 client.on_message = on_message
 client.on_disconnect = on_disconnect
 
+# Set up flow control towards the publishers
+flow_controller = FlowController(client, flow_control_topics, flow_control_mode, throttle_only_topics,
+                                 high_watermark, low_watermark, max_lag, flow_refresh, flow_max_level)
+
 try:
     # Connect to broker
     print(f"Connecting to broker: {broker_address}")
@@ -128,31 +450,40 @@ try:
     while running:
         current_time = time.time()
         
+        # Drain the messages queued since the last pass
+        depth = intake.qsize()
+        lag = 0.0
+        for _ in range(depth):
+            topic, payload, received = intake.get_nowait()
+            lag = max(lag, time.time() - received)
+            process_reading(topic, payload)
+        
+        with drop_lock:
+            dropped, dropped_messages = dropped_messages, 0
+        if dropped:
+            print(f"Intake queue full, dropped {dropped} messages")
+        
+        flow_controller.check(depth, lag)
+        
         # Process and publish data if we have both temperature and humidity
-        if (last_temp is not None and last_humidity is not None and 
-            current_time - last_publish_time >= publish_interval):
-            
-            # Calculate derived metrics
-            heat_index = calculate_heat_index(last_temp, last_humidity)
-            dew_point = calculate_dew_point(last_temp, last_humidity)
-            
-            # Create payload
-            data = {
-                "temperature": last_temp,
-                "humidity": last_humidity,
-                "heat_index": heat_index,
-                "dew_point": dew_point,
-                "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            }
-            
-            json_payload = json.dumps(data)
-            
-            # Publish processed data
-            client.publish(output_topic, json_payload)
-            print(f"Published processed data: Temperature={last_temp}°C, Humidity={last_humidity}%, "
-                  f"Heat Index={heat_index}°C, Dew Point={dew_point}°C")
+        if current_time - last_publish_time >= publish_interval:
+            # Recompute only the derived metrics whose inputs changed
+            values = pipeline.recompute()
             
-            last_publish_time = current_time
+            if "temperature" in values and "humidity" in values:
+                # Create payload
+                data = values
+                data["timestamp"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                
+                json_payload = json.dumps(data)
+                
+                # Publish processed data
+                client.publish(output_topic, json_payload)
+                print(f"Published processed data: Temperature={values['temperature']}°C, "
+                      f"Humidity={values['humidity']}%, Heat Index={values.get('heat_index')}°C, "
+                      f"Dew Point={values.get('dew_point')}°C")
+                
+                last_publish_time = current_time
         
         time.sleep(0.1)  # Small sleep to prevent CPU hogging
     